@@ -44,7 +44,8 @@
             python-multipart
             uvicorn
             pydantic
-            passlib
+            argon2-cffi
+            bcrypt
             asyncpg
             pyyaml
             python-jose
@@ -32,6 +32,11 @@ class DatabaseConfig(BaseModel):
 class CoreConfig(BaseModel):
     secret_key: str
     jwt_token_algorithm: str = "HS256"
+    # argon2id work factors for newly hashed user passwords, memory cost in KiB.
+    # existing hashes are verified with the parameters stored in the hash and rehashed on the next login
+    argon2_time_cost: int = 2
+    argon2_memory_cost: int = 64 * 1024
+    argon2_parallelism: int = 2
 
 
 class Config(BaseModel):
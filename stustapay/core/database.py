@@ -5,6 +5,7 @@ perform schema updates and get a db shell.
 import logging
 import asyncpg
 import contextlib
+import json
 import os
 import re
 import shutil
@@ -183,6 +184,14 @@ class SchemaRevision:
         return sorted_revisions
 
 
+async def init_db_connection(conn: asyncpg.Connection):
+    """
+    set up a freshly opened pool connection.
+    codecs are registered once per connection as changing them invalidates the prepared statement cache.
+    """
+    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
 async def create_db_pool(cfg: DatabaseConfig) -> asyncpg.Pool:
     """
     get a connection pool to the database
@@ -192,6 +201,7 @@ async def create_db_pool(cfg: DatabaseConfig) -> asyncpg.Pool:
         password=cfg.password,
         database=cfg.dbname,
         host=cfg.host,
+        init=init_db_connection,
     )
     if ret is None:
         raise Exception("failed to get db pool")
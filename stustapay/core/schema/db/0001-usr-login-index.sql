@@ -0,0 +1,8 @@
+-- revision: 6835866c
+-- requires: 62df6b55
+
+-- the login looks up the password hash by user name,
+-- including the hash in the unique index on usr.name makes this an index only scan.
+-- usr.user_tag_uid is already covered by its unique constraint.
+alter table usr drop constraint usr_name_key;
+alter table usr add constraint usr_name_key unique (name) include (id, password);
@@ -0,0 +1,11 @@
+-- revision: b69860f2
+-- requires: 6835866c
+
+-- build the privilege array per user with a subquery instead of aggregating all of usr_privs,
+-- lookups of single users can then use the primary key index of usr_privs.
+create or replace view usr_with_privileges as (
+    select
+        usr.*,
+        array(select p.priv from usr_privs p where p.usr = usr.id) as privileges
+    from usr
+);
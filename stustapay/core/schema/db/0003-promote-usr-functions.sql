@@ -0,0 +1,72 @@
+-- revision: 40bc2df6
+-- requires: b69860f2
+
+-- grant the cashier or finanzorga privilege to a user together with its internal account,
+-- i.e. the cashier account or the transport account of a finanzorga.
+-- users which already have the privilege are returned unchanged.
+-- returns no row if the user does not exist.
+create or replace function promote_usr (
+    user_id int,
+    privilege text
+)
+    returns setof usr_with_privileges as $$
+<<locals>> declare
+    user_name text;
+    account_id bigint;
+begin
+    select usr.name from usr where usr.id = promote_usr.user_id into locals.user_name;
+    if not found then
+        return;
+    end if;
+
+    perform from usr_privs where usr = promote_usr.user_id and priv = promote_usr.privilege;
+    if not found then
+        if promote_usr.privilege = 'cashier' then
+            insert into account (type, name)
+            values ('internal', 'Cashier account for ' || locals.user_name)
+            returning id into locals.account_id;
+            update usr set cashier_account_id = locals.account_id where id = promote_usr.user_id;
+        elsif promote_usr.privilege = 'finanzorga' then
+            insert into account (type, name)
+            values ('internal', 'Transport account for finanzorga ' || locals.user_name)
+            returning id into locals.account_id;
+            update usr set transport_account_id = locals.account_id where id = promote_usr.user_id;
+        else
+            raise 'users cannot be promoted to privilege %', promote_usr.privilege;
+        end if;
+
+        insert into usr_privs (usr, priv) values (promote_usr.user_id, promote_usr.privilege);
+    end if;
+
+    return query select * from usr_with_privileges where id = promote_usr.user_id;
+end;
+$$ language plpgsql;
+
+-- create a finanzorga for a user tag in one go, i.e. a user with the cashier and finanzorga privileges
+-- and their cashier and transport accounts, see promote_usr.
+-- if a user with the given tag already exists, it is promoted without changing its name.
+-- returns no row if the user tag does not exist.
+create or replace function create_finanzorga_user (
+    name text,
+    user_tag_uid bigint
+)
+    returns setof usr_with_privileges as $$
+<<locals>> declare
+    user_id int;
+begin
+    perform from user_tag where uid = create_finanzorga_user.user_tag_uid;
+    if not found then
+        return;
+    end if;
+
+    select usr.id from usr where usr.user_tag_uid = create_finanzorga_user.user_tag_uid into locals.user_id;
+    if locals.user_id is null then
+        insert into usr (name, user_tag_uid)
+        values (create_finanzorga_user.name, create_finanzorga_user.user_tag_uid)
+        returning id into locals.user_id;
+    end if;
+
+    perform promote_usr(locals.user_id, 'cashier');
+    return query select * from promote_usr(locals.user_id, 'finanzorga');
+end;
+$$ language plpgsql;
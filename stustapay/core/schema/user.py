@@ -4,7 +4,8 @@ from typing import Optional
 from pydantic import BaseModel
 
 
-class Privilege(enum.Enum):
+class Privilege(str, enum.Enum):
+    # str based such that privileges can be passed to the database as is
     admin = "admin"
     # orga = "orga"
     finanzorga = "finanzorga"
@@ -1,18 +1,49 @@
-# pylint: disable=unexpected-keyword-arg
+# pylint: disable=unexpected-keyword-arg,missing-kwoa
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
+import argon2
 import asyncpg
-from passlib.context import CryptContext
+import bcrypt
 from pydantic import BaseModel
 
 from stustapay.core.config import Config
-from stustapay.core.schema.account import AccountType
 from stustapay.core.schema.user import NewUser, Privilege, User, UserWithoutId
 from stustapay.core.service.auth import AuthService, UserTokenMetadata
 from stustapay.core.service.common.dbservice import DBService
-from stustapay.core.service.common.decorators import requires_terminal, requires_user_privileges, with_db_transaction
+from stustapay.core.service.common.decorators import (
+    requires_terminal,
+    requires_user_privileges,
+    with_db_connection,
+    with_db_transaction,
+)
 from stustapay.core.service.common.error import NotFoundException
 
+# password hashing is cpu bound but releases the GIL, so it is done in a bounded thread pool to not block the event loop
+_PASSWORD_HASH_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="password-hash")
+
+_ARGON2_PREFIX = "$argon2"
+
+# the password hash is never selected together with the user, it is only needed for the login check
+_USR_COLUMNS = "id, name, description, user_tag_uid, transport_account_id, cashier_account_id"
+_USER_COLUMNS = f"{_USR_COLUMNS}, privileges"
+
+
+def _user_from_row(row: asyncpg.Record) -> User:
+    # rows of usr_with_privileges are typed by the database schema, so the pydantic validation is skipped.
+    # all user queries select _USER_COLUMNS first, which allows indexing the record by position
+    return User.construct(
+        id=row[0],
+        name=row[1],
+        description=row[2],
+        user_tag_uid=row[3],
+        transport_account_id=row[4],
+        cashier_account_id=row[5],
+        privileges=[Privilege(privilege) for privilege in row[6]],
+    )
+
 
 class UserLoginSuccess(BaseModel):
     user: User
@@ -24,37 +55,75 @@ class UserService(DBService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
 
-        self.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        # new passwords are hashed with argon2id, bcrypt hashes are still verified and replaced on the next login.
+        # the hasher is per instance as it depends on the config, constructing it is cheap
+        self.password_hasher = argon2.PasswordHasher(
+            time_cost=config.core.argon2_time_cost,
+            memory_cost=config.core.argon2_memory_cost,
+            parallelism=config.core.argon2_parallelism,
+        )
+
+    def _verify_password(self, password: str, hashed_password: str) -> bool:
+        # a corrupt stored hash results in a failed login
+        if hashed_password.startswith(_ARGON2_PREFIX):
+            try:
+                return self.password_hasher.verify(hashed_password, password)
+            except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+                return False
+
+        # bcrypt only considers the first 72 bytes, truncate explicitly to stay compatible with existing hashes
+        try:
+            return bcrypt.checkpw(password.encode("utf-8")[:72], hashed_password.encode("utf-8"))
+        except ValueError:
+            return False
+
+    def _password_needs_rehash(self, hashed_password: str) -> bool:
+        return not hashed_password.startswith(_ARGON2_PREFIX) or self.password_hasher.check_needs_rehash(
+            hashed_password
+        )
 
-    def _hash_password(self, password: str) -> str:
-        return self.pwd_context.hash(password)
+    async def _hash_password(self, password: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(
+            _PASSWORD_HASH_EXECUTOR, self.password_hasher.hash, password
+        )
 
-    def _check_password(self, password: str, hashed_password: str) -> bool:
-        return self.pwd_context.verify(password, hashed_password)
+    async def _hash_many(self, passwords: list[str]) -> list[str]:
+        # independent hashes are spread over all threads of the hash executor, e.g. for bulk user creation
+        return list(await asyncio.gather(*(self._hash_password(password) for password in passwords)))
+
+    async def _check_password(self, password: str, hashed_password: Optional[str]) -> bool:
+        if hashed_password is None:
+            return False
+        return await asyncio.get_running_loop().run_in_executor(
+            _PASSWORD_HASH_EXECUTOR, self._verify_password, password, hashed_password
+        )
 
     async def _create_user(
         self, *, conn: asyncpg.Connection, new_user: UserWithoutId, password: Optional[str] = None
     ) -> User:
         hashed_password = None
         if password:
-            hashed_password = self._hash_password(password)
+            hashed_password = await self._hash_password(password)
 
-        user_id = await conn.fetchval(
-            "insert into usr (name, description, password, user_tag_uid, transport_account_id, cashier_account_id) "
-            "values ($1, $2, $3, $4, $5, $6) returning id",
+        # data modifying CTEs are not visible to the usr_with_privileges view within the same statement,
+        # therefore the privileges are returned as they were inserted
+        row = await conn.fetchrow(
+            "with new_usr as ("
+            "   insert into usr (name, description, password, user_tag_uid, transport_account_id, cashier_account_id) "
+            f"  values ($1, $2, $3, $4, $5, $6) returning {_USR_COLUMNS}"
+            "), new_privs as ("
+            "   insert into usr_privs (usr, priv) select new_usr.id, unnest($7::text array) from new_usr"
+            ") "
+            "select new_usr.*, $7::text array as privileges from new_usr",
             new_user.name,
             new_user.description,
             hashed_password,
             new_user.user_tag_uid,
             new_user.transport_account_id,
             new_user.cashier_account_id,
+            new_user.privileges,
         )
-
-        for privilege in new_user.privileges:
-            await conn.execute("insert into usr_privs (usr, priv) values ($1, $2)", user_id, privilege.value)
-
-        row = await conn.fetchrow("select * from usr_with_privileges where id = $1", user_id)
-        return User.parse_obj(row)
+        return _user_from_row(row)
 
     @with_db_transaction
     async def create_user_no_auth(
@@ -78,11 +147,14 @@ class UserService(DBService):
 
     @with_db_transaction
     @requires_terminal([Privilege.admin])
-    async def create_finanzorga(self, *, conn: asyncpg.Connection, current_user: User, new_user: NewUser) -> User:
-        user = await self.create_user_with_tag(current_user=current_user, conn=conn, new_user=new_user)
-        user = await self.promote_to_cashier(current_user=current_user, conn=conn, user_id=user.id)
-        user = await self.promote_to_finanzorga(current_user=current_user, conn=conn, user_id=user.id)
-        return user
+    async def create_finanzorga(self, *, conn: asyncpg.Connection, new_user: NewUser) -> User:
+        # creates or promotes the user including its accounts and privileges in a single database function call
+        row = await conn.fetchrow(
+            f"select {_USER_COLUMNS} from create_finanzorga_user($1, $2)", new_user.name, new_user.user_tag_uid
+        )
+        if row is None:
+            raise NotFoundException(element_typ="user_tag", element_id=str(new_user.user_tag_uid))
+        return _user_from_row(row)
 
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
@@ -97,10 +169,12 @@ class UserService(DBService):
         if user_tag_uid is None:
             raise NotFoundException(element_typ="user_tag", element_id=str(new_user.user_tag_uid))
 
-        existing_user = await conn.fetchrow("select * from usr_with_privileges where user_tag_uid = $1", user_tag_uid)
+        existing_user = await conn.fetchrow(
+            f"select {_USER_COLUMNS} from usr_with_privileges where user_tag_uid = $1", user_tag_uid
+        )
         if existing_user is not None:
             # ignore the name provided in new_user
-            return User.parse_obj(existing_user)
+            return _user_from_row(existing_user)
 
         user = UserWithoutId(
             name=new_user.name,
@@ -109,58 +183,37 @@ class UserService(DBService):
         )
         return await self._create_user(conn=conn, new_user=user)
 
+    async def _promote_user(self, *, conn: asyncpg.Connection, user_id: int, privilege: Privilege) -> User:
+        """
+        Grant a privilege to a user together with its internal account, see the promote_usr database function.
+        If the user already has the privilege, it is returned unchanged.
+        """
+        row = await conn.fetchrow(f"select {_USER_COLUMNS} from promote_usr($1, $2)", user_id, privilege)
+        if row is None:
+            raise NotFoundException(element_typ="user", element_id=str(user_id))
+        return _user_from_row(row)
+
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
     async def promote_to_cashier(self, *, conn: asyncpg.Connection, user_id: int) -> User:
-        user = await self._get_user(conn=conn, user_id=user_id)
-        if user is None:
-            raise NotFoundException(element_typ="user", element_id=str(user_id))
-
-        if Privilege.cashier in user.privileges:
-            return user
-
-        # create cashier account
-        user.cashier_account_id = await conn.fetchval(
-            "insert into account (type, name) values ($1, $2) returning id",
-            AccountType.internal.value,
-            f"Cashier account for {user.name}",
-        )
-        user.privileges.append(Privilege.cashier)
-        return await self._update_user(conn=conn, user_id=user.id, user=user)
+        return await self._promote_user(conn=conn, user_id=user_id, privilege=Privilege.cashier)
 
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
     async def promote_to_finanzorga(self, *, conn: asyncpg.Connection, user_id: int) -> User:
-        user = await self._get_user(conn=conn, user_id=user_id)
-        if user is None:
-            raise NotFoundException(element_typ="user", element_id=str(user_id))
-
-        if Privilege.finanzorga in user.privileges:
-            return user
-
-        # create backpack account
-        user.transport_account_id = await conn.fetchval(
-            "insert into account (type, name) values ($1, $2) returning id",
-            AccountType.internal.value,
-            f"Transport account for finanzorga {user.name}",
-        )
-        user.privileges.append(Privilege.finanzorga)
-        return await self._update_user(conn=conn, user_id=user.id, user=user)
+        return await self._promote_user(conn=conn, user_id=user_id, privilege=Privilege.finanzorga)
 
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
     async def list_users(self, *, conn: asyncpg.Connection) -> list[User]:
-        cursor = conn.cursor("select * from usr_with_privileges")
-        result = []
-        async for row in cursor:
-            result.append(User.parse_obj(row))
-        return result
+        rows = await conn.fetch(f"select {_USER_COLUMNS} from usr_with_privileges")
+        return [_user_from_row(row) for row in rows]
 
     async def _get_user(self, conn: asyncpg.Connection, user_id: int) -> User:
-        row = await conn.fetchrow("select * from usr_with_privileges where id = $1", user_id)
+        row = await conn.fetchrow(f"select {_USER_COLUMNS} from usr_with_privileges where id = $1", user_id)
         if row is None:
             raise NotFoundException(element_typ="user", element_id=str(user_id))
-        return User.parse_obj(row)
+        return _user_from_row(row)
 
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
@@ -168,26 +221,32 @@ class UserService(DBService):
         return await self._get_user(conn, user_id)
 
     async def _update_user(self, *, conn: asyncpg.Connection, user_id: int, user: UserWithoutId) -> User:
+        # only privileges which were revoked are deleted and only new ones are inserted such that the
+        # sub-statements of the CTE never touch the same rows
         row = await conn.fetchrow(
-            "update usr "
-            "set name = $2, description = $3, user_tag_uid = $4, transport_account_id = $5, cashier_account_id = $6 "
-            "where id = $1 returning id",
+            "with updated_usr as ("
+            "   update usr "
+            "   set name = $2, description = $3, user_tag_uid = $4, transport_account_id = $5, cashier_account_id = $6 "
+            f"  where id = $1 returning {_USR_COLUMNS}"
+            "), revoked_privs as ("
+            "   delete from usr_privs where usr = $1 and priv <> all($7::text array)"
+            "), granted_privs as ("
+            "   insert into usr_privs (usr, priv) select updated_usr.id, unnest($7::text array) from updated_usr "
+            "   on conflict do nothing"
+            ") "
+            "select updated_usr.*, $7::text array as privileges from updated_usr",
             user_id,
             user.name,
             user.description,
             user.user_tag_uid,
             user.transport_account_id,
             user.cashier_account_id,
+            user.privileges,
         )
         if row is None:
             raise NotFoundException(element_typ="user", element_id=str(user_id))
 
-        # Update privileges
-        await conn.execute("delete from usr_privs where usr = $1", user_id)
-        for privilege in user.privileges:
-            await conn.execute("insert into usr_privs (usr, priv) values ($1, $2)", user_id, privilege.value)
-
-        return await self._get_user(conn, user_id)
+        return _user_from_row(row)
 
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
@@ -197,11 +256,11 @@ class UserService(DBService):
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
     async def delete_user(self, *, conn: asyncpg.Connection, user_id: int) -> bool:
-        result = await conn.execute(
-            "delete from usr where id = $1",
+        result = await conn.fetchval(
+            "delete from usr where id = $1 returning id",
             user_id,
         )
-        return result != "DELETE 0"
+        return result is not None
 
     @with_db_transaction
     @requires_user_privileges([Privilege.admin])
@@ -225,25 +284,65 @@ class UserService(DBService):
         )
         return result is not None
 
+    @with_db_connection
+    async def _fetch_login_credentials(self, *, conn: asyncpg.Connection, username: str) -> Optional[asyncpg.Record]:
+        return await conn.fetchrow("select id, password from usr where name = $1", username)
+
     @with_db_transaction
-    async def login_user(self, *, conn: asyncpg.Connection, username: str, password: str) -> Optional[UserLoginSuccess]:
+    async def _create_user_session(
+        self,
+        *,
+        conn: asyncpg.Connection,
+        user_id: int,
+        old_password_hash: Optional[str] = None,
+        new_password_hash: Optional[str] = None,
+    ) -> Optional[UserLoginSuccess]:
+        if new_password_hash is not None:
+            # the password might have been changed since it was checked, only replace the hash which was verified
+            await conn.execute(
+                "update usr set password = $2 where id = $1 and password = $3",
+                user_id,
+                new_password_hash,
+                old_password_hash,
+            )
+
         row = await conn.fetchrow(
-            "select * from usr_with_privileges where name = $1",
-            username,
+            "with new_session as ("
+            "   insert into usr_session (usr) select id from usr where id = $1 returning id as session_id"
+            ") "
+            f"select {_USER_COLUMNS}, new_session.session_id from usr_with_privileges, new_session where id = $1",
+            user_id,
         )
         if row is None:
+            # the user was deleted after the password check, no session was created
+            return None
+
+        token = self.auth_service.create_user_access_token(
+            UserTokenMetadata(user_id=user_id, session_id=row["session_id"])
+        )
+        return UserLoginSuccess(
+            user=_user_from_row(row),
+            token=token,
+        )
+
+    async def login_user(self, *, username: str, password: str) -> Optional[UserLoginSuccess]:
+        # only the password hash is fetched up front, the database connection is released while the (slow)
+        # password check is running and the full user is only fetched after a successful login
+        credentials = await self._fetch_login_credentials(username=username)
+        if credentials is None:
             return None
 
-        if not self._check_password(password, row["password"]):
+        if not await self._check_password(password, credentials["password"]):
             return None
 
-        user = User.parse_obj(row)
+        new_password_hash = None
+        if self._password_needs_rehash(credentials["password"]):
+            new_password_hash = await self._hash_password(password)
 
-        session_id = await conn.fetchval("insert into usr_session (usr) values ($1) returning id", user.id)
-        token = self.auth_service.create_user_access_token(UserTokenMetadata(user_id=user.id, session_id=session_id))
-        return UserLoginSuccess(
-            user=user,
-            token=token,
+        return await self._create_user_session(
+            user_id=credentials["id"],
+            old_password_hash=credentials["password"],
+            new_password_hash=new_password_hash,
         )
 
     @with_db_transaction
@@ -256,7 +355,7 @@ class UserService(DBService):
         if current_user.id != token_payload.user_id:
             return False
 
-        result = await conn.execute(
-            "delete from usr_session where usr = $1 and id = $2", current_user.id, token_payload.session_id
+        result = await conn.fetchval(
+            "delete from usr_session where usr = $1 and id = $2 returning id", current_user.id, token_payload.session_id
         )
-        return result != "DELETE 0"
+        return result is not None
@@ -57,6 +57,8 @@ class DummyTerminal:
     async def _run(self, conn: asyncpg.Connection):
         self.logger.info("Starting dummy terminal")
         login_result = await self.user_service.login_user(username="admin", password="admin")
+        if login_result is None:
+            raise RuntimeError("could not log in as admin, is the example data loaded?")
         admin_token = login_result.token
 
         await self.till_service.logout_terminal_id(token=admin_token, till_id=0)
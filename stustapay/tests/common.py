@@ -28,7 +28,8 @@ def get_test_db_config() -> dict:
 
 # input structure for core.config.Config
 TEST_CONFIG = {
-    "core": {"secret_key": "asdf1234"},
+    # cheap password hashing parameters to keep the tests fast
+    "core": {"secret_key": "asdf1234", "argon2_time_cost": 1, "argon2_memory_cost": 8, "argon2_parallelism": 1},
     "administration": {
         "base_url": "http://localhost:8081",
         "host": "localhost",
@@ -56,6 +57,7 @@ async def get_test_db() -> Pool:
         port=cfg["port"],
         min_size=5,
         max_size=5,
+        init=database.init_db_connection,
     )
 
     await database.reset_schema(pool)
@@ -86,14 +88,16 @@ class BaseTestCase(TestCase):
             new_user=UserWithoutId(name="test-admin-user", description="", privileges=[Privilege.admin]),
             password="asdf",
         )
-        self.admin_token = (await self.user_service.login_user(username=self.admin_user.name, password="asdf")).token
+        admin_login = await self.user_service.login_user(username=self.admin_user.name, password="asdf")
+        assert admin_login is not None
+        self.admin_token = admin_login.token
         self.cashier_user = await self.user_service.create_user_no_auth(
             new_user=UserWithoutId(name="test-cashier-user", description="", privileges=[Privilege.cashier]),
             password="asdf",
         )
-        self.cashier_token = (
-            await self.user_service.login_user(username=self.cashier_user.name, password="asdf")
-        ).token
+        cashier_login = await self.user_service.login_user(username=self.cashier_user.name, password="asdf")
+        assert cashier_login is not None
+        self.cashier_token = cashier_login.token
 
     async def asyncTearDown(self) -> None:
         await self.db_conn.close()
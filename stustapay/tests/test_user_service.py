@@ -1,5 +1,7 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
-from stustapay.core.schema.user import NewUser, Privilege, UserWithoutId
+import bcrypt
+
+from stustapay.core.schema.user import NewUser, Privilege, User, UserWithoutId
 from stustapay.tests.common import BaseTestCase
 
 
@@ -18,6 +20,12 @@ class UserServiceTest(BaseTestCase):
         )
         await self.till_service.login_user(token=self.terminal_token, user_tag_uid=admin_tag_uid)
 
+    async def assert_user_matches_db(self, user: User):
+        db_user = await self.user_service.get_user(token=self.admin_token, user_id=user.id)
+        self.assertIsNotNone(db_user)
+        self.assertDictEqual(user.dict(exclude={"privileges"}), db_user.dict(exclude={"privileges"}))
+        self.assertSetEqual(set(user.privileges), set(db_user.privileges))
+
     async def test_user_creation(self):
         cashier = await self.user_service.create_cashier(
             token=self.terminal_token, new_user=NewUser(name="test-cashier", user_tag_uid=self.cashier_uid)
@@ -28,6 +36,7 @@ class UserServiceTest(BaseTestCase):
         self.assertIsNotNone(cashier.cashier_account_id)
         self.assertIsNone(cashier.transport_account_id)
         self.assertEqual(cashier.user_tag_uid, self.cashier_uid)
+        await self.assert_user_matches_db(cashier)
         # Test creation if user already exists
         await self.user_service.create_cashier(
             token=self.terminal_token, new_user=NewUser(name="test-cashier", user_tag_uid=self.cashier_uid)
@@ -41,3 +50,102 @@ class UserServiceTest(BaseTestCase):
         self.assertSetEqual(set(finanzorga.privileges), {Privilege.cashier, Privilege.finanzorga})
         self.assertIsNotNone(finanzorga.transport_account_id)
         self.assertEqual(finanzorga.user_tag_uid, self.finanzorga_uid)
+        await self.assert_user_matches_db(finanzorga)
+
+        # promote an existing cashier, its name and cashier account are kept
+        promoted_cashier = await self.user_service.create_finanzorga(
+            token=self.terminal_token, new_user=NewUser(name="other-name", user_tag_uid=self.cashier_uid)
+        )
+        self.assertEqual(promoted_cashier.id, cashier.id)
+        self.assertEqual(promoted_cashier.name, "test-cashier")
+        self.assertEqual(promoted_cashier.cashier_account_id, cashier.cashier_account_id)
+        self.assertIsNotNone(promoted_cashier.transport_account_id)
+        self.assertSetEqual(set(promoted_cashier.privileges), {Privilege.cashier, Privilege.finanzorga})
+
+    async def test_update_user_privileges(self):
+        user = await self.user_service.create_user(
+            token=self.admin_token,
+            new_user=UserWithoutId(
+                name="test-privileges", description="", privileges=[Privilege.admin, Privilege.cashier]
+            ),
+            password="asdf",
+        )
+        self.assertSetEqual(set(user.privileges), {Privilege.admin, Privilege.cashier})
+        await self.assert_user_matches_db(user)
+
+        # revoke admin, keep cashier and grant finanzorga
+        user.privileges = [Privilege.cashier, Privilege.finanzorga]
+        updated_user = await self.user_service.update_user(token=self.admin_token, user_id=user.id, user=user)
+        self.assertSetEqual(set(updated_user.privileges), {Privilege.cashier, Privilege.finanzorga})
+        await self.assert_user_matches_db(updated_user)
+
+        user.privileges = []
+        updated_user = await self.user_service.update_user(token=self.admin_token, user_id=user.id, user=user)
+        self.assertListEqual(updated_user.privileges, [])
+        await self.assert_user_matches_db(updated_user)
+
+    async def test_login_of_user_deleted_during_password_check(self):
+        user = await self.user_service.create_user_no_auth(
+            new_user=UserWithoutId(name="test-deleted-login", description="", privileges=[]), password="asdf"
+        )
+        check_password = self.user_service._check_password  # pylint: disable=protected-access
+
+        async def delete_user_and_check_password(password: str, hashed_password: str) -> bool:
+            await self.db_conn.execute("delete from usr where id = $1", user.id)
+            return await check_password(password, hashed_password)
+
+        self.user_service._check_password = delete_user_and_check_password  # pylint: disable=protected-access
+        login_result = await self.user_service.login_user(username=user.name, password="asdf")
+        self.assertIsNone(login_result)
+
+    async def test_hash_many(self):
+        # pylint: disable=protected-access
+        passwords = ["first", "second", "second"]
+        hashes = await self.user_service._hash_many(passwords)
+        self.assertEqual(len(hashes), len(passwords))
+        # salted hashes differ, even for equal passwords
+        self.assertEqual(len(set(hashes)), len(hashes))
+        for password, hashed_password in zip(passwords, hashes):
+            self.assertTrue(await self.user_service._check_password(password, hashed_password))
+        self.assertFalse(await self.user_service._check_password("first", hashes[1]))
+
+    async def test_login_rehashes_bcrypt_password(self):
+        bcrypt_hash = bcrypt.hashpw(b"asdf", bcrypt.gensalt(rounds=4)).decode("utf-8")
+        user_id = await self.db_conn.fetchval(
+            "insert into usr (name, password) values ('test-bcrypt-user', $1) returning id", bcrypt_hash
+        )
+
+        self.assertIsNone(await self.user_service.login_user(username="test-bcrypt-user", password="wrong"))
+        self.assertEqual(await self.db_conn.fetchval("select password from usr where id = $1", user_id), bcrypt_hash)
+
+        login_result = await self.user_service.login_user(username="test-bcrypt-user", password="asdf")
+        self.assertIsNotNone(login_result)
+        self.assertEqual(login_result.user.id, user_id)
+        new_hash = await self.db_conn.fetchval("select password from usr where id = $1", user_id)
+        self.assertTrue(new_hash.startswith("$argon2id$"))
+
+        # the new hash is used for the next login and is not rehashed again
+        self.assertIsNotNone(await self.user_service.login_user(username="test-bcrypt-user", password="asdf"))
+        self.assertEqual(await self.db_conn.fetchval("select password from usr where id = $1", user_id), new_hash)
+        self.assertIsNone(await self.user_service.login_user(username="test-bcrypt-user", password="wrong"))
+
+    async def test_login_rehash_keeps_concurrently_changed_password(self):
+        bcrypt_hash = bcrypt.hashpw(b"asdf", bcrypt.gensalt(rounds=4)).decode("utf-8")
+        changed_hash = bcrypt.hashpw(b"changed", bcrypt.gensalt(rounds=4)).decode("utf-8")
+        user_id = await self.db_conn.fetchval(
+            "insert into usr (name, password) values ('test-bcrypt-user', $1) returning id", bcrypt_hash
+        )
+        check_password = self.user_service._check_password  # pylint: disable=protected-access
+
+        async def change_password_and_check_password(password: str, hashed_password: str) -> bool:
+            await self.db_conn.execute("update usr set password = $2 where id = $1", user_id, changed_hash)
+            return await check_password(password, hashed_password)
+
+        self.user_service._check_password = change_password_and_check_password  # pylint: disable=protected-access
+        self.assertIsNotNone(await self.user_service.login_user(username="test-bcrypt-user", password="asdf"))
+        self.assertEqual(await self.db_conn.fetchval("select password from usr where id = $1", user_id), changed_hash)
+
+    async def test_check_password_with_corrupt_hash(self):
+        # pylint: disable=protected-access
+        for corrupt_hash in ["$argon2id$v=19$m=8,t=1,p=1$broken", "$argon2id$", "not a hash", "$2b$12$broken"]:
+            self.assertFalse(await self.user_service._check_password("asdf", corrupt_hash))